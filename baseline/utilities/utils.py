@@ -1,7 +1,8 @@
 from __future__ import print_function
 
-import glob
+import math
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -12,11 +13,29 @@ import librosa
 import torch
 from desed.utils import create_folder
 from torch import nn
-from dcase_util.data import DecisionEncoder
 
 import config as cfg
 
 
+def _find_regions(labels_2d):
+    """ Find the contiguous active regions of every column of an encoded label matrix at once
+
+    Args:
+        labels_2d: numpy.array, (n_frames, n_labels) matrix of binary activations
+
+    Returns:
+        tuple of numpy.array
+        (label_indices, onsets, offsets), one entry per contiguous region, ordered by label column
+        then by onset (offsets are exclusive)
+    """
+    activity = np.zeros((labels_2d.shape[1], labels_2d.shape[0] + 2), dtype=np.int8)
+    activity[:, 1:-1] = labels_2d.T > 0
+    changes = np.diff(activity, axis=1)
+    label_indices, onsets = np.nonzero(changes == 1)
+    _, offsets = np.nonzero(changes == -1)
+    return label_indices, onsets, offsets
+
+
 class ManyHotEncoder:
     """"
         Adapted after DecisionEncoder.find_contiguous_regions method in
@@ -36,6 +55,7 @@ class ManyHotEncoder:
             labels = labels.tolist()
         self.labels = labels
         self.n_frames = n_frames
+        self._label_to_idx = {label: i for i, label in enumerate(labels)}
 
     def encode_weak(self, labels):
         """ Encode a list of weak labels into a numpy array
@@ -50,52 +70,94 @@ class ManyHotEncoder:
         # useful for tensor empty labels
         if type(labels) is str:
             if labels == "empty":
-                y = np.zeros(len(self.labels)) - 1
+                y = np.full(len(self.labels), -1.0, dtype=np.float32)
                 return y
         if type(labels) is pd.DataFrame:
             if labels.empty:
                 labels = []
             elif "event_label" in labels.columns:
                 labels = labels["event_label"]
-        y = np.zeros(len(self.labels))
-        for label in labels:
-            if not pd.isna(label):
-                i = self.labels.index(label)
-                y[i] = 1
+        labels = np.asarray(labels, dtype=object)
+        mask = pd.notna(labels)
+        idx = np.fromiter((self._label_to_idx[label] for label in labels[mask]),
+                          dtype=np.int64, count=int(mask.sum()))
+        y = np.zeros(len(self.labels), dtype=np.float32)
+        y[idx] = 1
         return y
 
-    def encode_strong_df(self, label_df):
+    def _fill_strong(self, onsets, offsets, idx, y):
+        """ Fill an encoded matrix from event boundary arrays with one cumulative-sum scatter
+
+        Args:
+            onsets: numpy.array, onset frame of each event
+            offsets: numpy.array, offset frame of each event (not included)
+            idx: numpy.array, label index of each event
+            y: numpy.array, (n_frames, n_labels) matrix to fill
+        Returns:
+            numpy.array
+            The filled matrix y
+        """
+        onsets = np.clip(onsets, 0, self.n_frames)
+        offsets = np.clip(offsets, 0, self.n_frames)
+        # Drop degenerate events (onset >= offset, an empty slice in the baseline code); their
+        # early -1 would otherwise cancel frames of other events with the same label in the sum
+        keep = onsets < offsets
+        if not keep.all():
+            onsets, offsets, idx = onsets[keep], offsets[keep], idx[keep]
+        # Scatter +1/-1 at event boundaries, a cumulative sum then marks every frame
+        # in between (offset not included, hypothesis of overlapping frames, so ok).
+        diff = np.zeros((self.n_frames + 1, len(self.labels)), dtype=np.int16)
+        np.add.at(diff, (onsets, idx), 1)
+        np.add.at(diff, (offsets, idx), -1)
+        y[:] = np.cumsum(diff, axis=0)[:-1] > 0
+        return y
+
+    def encode_strong_df(self, label_df, out=None):
         """Encode a list (or pandas Dataframe or Serie) of strong labels, they correspond to a given filename
 
         Args:
             label_df: pandas DataFrame or Series, contains filename, onset (in frames) and offset (in frames)
                 If only filename (no onset offset) is specified, it will return the event on all the frames
                 onset and offset should be in frames
+                An integer ndarray of (onset, offset, label index) rows is also accepted, for callers
+                which precompute the events once (e.g. dataloader workers)
+            out: numpy.array, (Default value = None) optional (n_frames, n_labels) buffer to encode into,
+                so callers can reuse one (possibly pinned) buffer per worker instead of allocating per sample
         Returns:
             numpy.array
             Encoded labels, 1 where the label is present, 0 otherwise
         """
 
         assert self.n_frames is not None, "n_frames need to be specified when using strong encoder"
+        if out is None:
+            y = np.zeros((self.n_frames, len(self.labels)), dtype=np.float32)
+        else:
+            y = out
+            y.fill(0)
+        if isinstance(label_df, np.ndarray) and label_df.ndim == 2 and label_df.shape[1] == 3 \
+                and np.issubdtype(label_df.dtype, np.integer):
+            return self._fill_strong(label_df[:, 0], label_df[:, 1], label_df[:, 2], y)
         if type(label_df) is str:
             if label_df == 'empty':
-                y = np.zeros((self.n_frames, len(self.labels))) - 1
+                y.fill(-1)
                 return y
-        y = np.zeros((self.n_frames, len(self.labels)))
         if type(label_df) is pd.DataFrame:
             if {"onset", "offset", "event_label"}.issubset(label_df.columns):
-                for _, row in label_df.iterrows():
-                    if not pd.isna(row["event_label"]):
-                        i = self.labels.index(row["event_label"])
-                        onset = int(row["onset"])
-                        offset = int(row["offset"])
-                        y[onset:offset, i] = 1  # means offset not included (hypothesis of overlapping frames, so ok)
+                sub_df = label_df.dropna(subset=["event_label"])
+                mapped = sub_df["event_label"].map(self._label_to_idx)
+                if mapped.isna().any():
+                    unknown = sub_df["event_label"][mapped.isna()].unique().tolist()
+                    raise ValueError("labels {} are not in the encoder labels".format(unknown))
+                idx = mapped.to_numpy(np.int64)
+                onsets = sub_df["onset"].to_numpy(np.int64)
+                offsets = sub_df["offset"].to_numpy(np.int64)
+                self._fill_strong(onsets, offsets, idx, y)
 
         elif type(label_df) in [pd.Series, list, np.ndarray]:  # list of list or list of strings
             if type(label_df) is pd.Series:
                 if {"onset", "offset", "event_label"}.issubset(label_df.index):  # means only one value
                     if not pd.isna(label_df["event_label"]):
-                        i = self.labels.index(label_df["event_label"])
+                        i = self._label_to_idx[label_df["event_label"]]
                         onset = int(label_df["onset"])
                         offset = int(label_df["offset"])
                         y[onset:offset, i] = 1
@@ -104,14 +166,14 @@ class ManyHotEncoder:
             for event_label in label_df:
                 # List of string, so weak labels to be encoded in strong
                 if type(event_label) is str:
-                    if event_label is not "":
-                        i = self.labels.index(event_label)
+                    if event_label != "":
+                        i = self._label_to_idx[event_label]
                         y[:, i] = 1
 
                 # List of list, with [label, onset, offset]
                 elif len(event_label) == 3:
-                    if event_label[0] is not "":
-                        i = self.labels.index(event_label[0])
+                    if event_label[0] != "":
+                        i = self._label_to_idx[event_label[0]]
                         onset = int(event_label[1])
                         offset = int(event_label[2])
                         y[onset:offset, i] = 1
@@ -150,13 +212,12 @@ class ManyHotEncoder:
             Decoded labels, list of list: [[label, onset offset], ...]
 
         """
-        result_labels = []
-        for i, label_column in enumerate(labels.T):
-            change_indices = DecisionEncoder().find_contiguous_regions(label_column)
+        label_indices, onsets, offsets = _find_regions(np.asarray(labels))
 
-            # append [label, onset, offset] in the result list
-            for row in change_indices:
-                result_labels.append([self.labels[i], row[0], row[1]])
+        # append [label, onset, offset] in the result list
+        result_labels = []
+        for k in range(len(label_indices)):
+            result_labels.append([self.labels[label_indices[k]], onsets[k], offsets[k]])
         return result_labels
 
     def state_dict(self):
@@ -182,49 +243,58 @@ def read_audio(path, target_fs=None):
         (numpy.array, sampling rate), array containing the audio at the sampling rate given
 
     """
-    (audio, fs) = soundfile.read(path)
+    (audio, fs) = soundfile.read(path, dtype="float32")
     if audio.ndim > 1:
-        audio = np.mean(audio, axis=1)
+        audio = np.mean(audio, axis=1, dtype=np.float32)
     if target_fs is not None and fs != target_fs:
-        audio = librosa.resample(audio, orig_sr=fs, target_sr=target_fs)
+        audio = librosa.resample(audio, orig_sr=fs, target_sr=target_fs, res_type="soxr_hq")
         fs = target_fs
     return audio, fs
 
 
+_conv_init_gain = math.sqrt(2.0)
+
+
 def weights_init(m):
     """ Initialize the weights of some layers of neural networks, here Conv2D, BatchNorm, GRU, Linear
         Based on the work of Xavier Glorot
     Args:
         m: the model to initialize
     """
-    classname = m.__class__.__name__
-    if classname.find('Conv2d') != -1:
-        nn.init.xavier_uniform_(m.weight, gain=np.sqrt(2))
+    if isinstance(m, nn.Conv2d):
+        nn.init.xavier_uniform_(m.weight, gain=_conv_init_gain)
         m.bias.data.fill_(0)
-    elif classname.find('BatchNorm') != -1:
+    elif isinstance(m, nn.modules.batchnorm._BatchNorm):
         m.weight.data.normal_(1.0, 0.02)
         m.bias.data.fill_(0)
-    elif classname.find('GRU') != -1:
+    elif isinstance(m, nn.GRU):
         for weight in m.parameters():
             if len(weight.size()) > 1:
                 nn.init.orthogonal_(weight.data)
-    elif classname.find('Linear') != -1:
+    elif isinstance(m, nn.Linear):
         m.weight.data.normal_(0, 0.01)
         m.bias.data.zero_()
 
 
+_cuda_available = torch.cuda.is_available()
+_device = torch.device("cuda" if _cuda_available else "cpu")
+
+
 def to_cuda_if_available(*args):
     """ Transfer object (Module, Tensor) to GPU if GPU available
     Args:
-        args: torch object to put on cuda if available (needs to have object.cuda() defined)
+        args: torch object to put on cuda if available (needs to have object.to() defined)
 
     Returns:
         Objects on GPU if GPUs available
+    Note:
+        Transfers are done with non_blocking=True, so they overlap with compute when the
+        source tensor lives in pinned memory.
     """
-    res = list(args)
-    if torch.cuda.is_available():
-        for i, torch_obj in enumerate(args):
-            res[i] = torch_obj.cuda()
+    if _cuda_available:
+        res = [torch_obj.to(_device, non_blocking=True) for torch_obj in args]
+    else:
+        res = list(args)
     if len(res) == 1:
         return res[0]
     return res
@@ -244,12 +314,11 @@ class SaveBest:
     """
     def __init__(self, val_comp="inf"):
         self.comp = val_comp
-        if val_comp == "inf":
-            self.best_val = np.inf
-        elif val_comp == "sup":
-            self.best_val = 0
-        else:
+        if val_comp not in ["inf", "sup"]:
             raise NotImplementedError("value comparison is only 'inf' or 'sup'")
+        # +1 compares downwards ("inf"), -1 flips the comparison for "sup"
+        self._sign = -1 if val_comp == "sup" else 1
+        self.best_val = self._sign * np.inf
         self.best_epoch = 0
         self.current_epoch = 0
 
@@ -261,7 +330,7 @@ class SaveBest:
         decision = False
         if self.current_epoch == 0:
             decision = True
-        if (self.comp == "inf" and value < self.best_val) or (self.comp == "sup" and value > self.best_val):
+        if value * self._sign < self.best_val * self._sign:
             self.best_epoch = self.current_epoch
             self.best_val = value
             decision = True
@@ -287,12 +356,11 @@ class EarlyStopping:
         self.patience = patience
         self.first_early_wait = init_patience
         self.val_comp = val_comp
-        if val_comp == "inf":
-            self.best_val = np.inf
-        elif val_comp == "sup":
-            self.best_val = 0
-        else:
+        if val_comp not in ["inf", "sup"]:
             raise NotImplementedError("value comparison is only 'inf' or 'sup'")
+        # +1 compares downwards ("inf"), -1 flips the comparison for "sup"
+        self._sign = -1 if val_comp == "sup" else 1
+        self.best_val = self._sign * np.inf
         self.current_epoch = 0
         self.best_epoch = 0
 
@@ -302,14 +370,7 @@ class EarlyStopping:
         Args:
             value: the value of the metric followed
         """
-        current = False
-        if self.val_comp == "inf":
-            if value < self.best_val:
-                current = True
-        if self.val_comp == "sup":
-            if value > self.best_val:
-                current = True
-        if current:
+        if value * self._sign < self.best_val * self._sign:
             self.best_val = value
             self.best_epoch = self.current_epoch
         elif self.current_epoch - self.best_epoch > self.patience and self.current_epoch > self.first_early_wait:
@@ -320,41 +381,53 @@ class EarlyStopping:
 
 
 class AverageMeterSet:
+    """ Set of named running averages stored as flat arrays (one slot per meter name),
+    so updating a meter in the training loop is two indexed adds and the averages are
+    computed vector-wise only when asked for """
     def __init__(self):
-        self.meters = {}
+        self._idx = {}
+        self._val = np.zeros(0)
+        self._sum = np.zeros(0)
+        self._count = np.zeros(0)
 
     def __getitem__(self, key):
-        return self.meters[key]
+        return self._val[self._idx[key]]
 
     def update(self, name, value, n=1):
-        if name not in self.meters:
-            self.meters[name] = AverageMeter()
-        self.meters[name].update(value, n)
+        i = self._idx.get(name)
+        if i is None:
+            i = self._idx[name] = len(self._idx)
+            self._val = np.resize(self._val, len(self._idx))
+            self._sum = np.resize(self._sum, len(self._idx))
+            self._count = np.resize(self._count, len(self._idx))
+            self._val[i] = self._sum[i] = self._count[i] = 0
+        self._val[i] = value
+        self._sum[i] += value * n
+        self._count[i] += n
 
     def reset(self):
-        for meter in self.meters.values():
-            meter.reset()
+        self._val[:] = 0
+        self._sum[:] = 0
+        self._count[:] = 0
 
     def values(self, postfix=''):
-        return {name + postfix: meter.val for name, meter in self.meters.items()}
+        return {name + postfix: self._val[i] for name, i in self._idx.items()}
 
     def averages(self, postfix='/avg'):
-        return {name + postfix: meter.avg for name, meter in self.meters.items()}
+        avg = self._sum / np.maximum(self._count, 1)
+        return {name + postfix: avg[i] for name, i in self._idx.items()}
 
     def sums(self, postfix='/sum'):
-        return {name + postfix: meter.sum for name, meter in self.meters.items()}
+        return {name + postfix: self._sum[i] for name, i in self._idx.items()}
 
     def counts(self, postfix='/count'):
-        return {name + postfix: meter.count for name, meter in self.meters.items()}
+        return {name + postfix: self._count[i] for name, i in self._idx.items()}
 
     def __str__(self):
-        string = ""
-        for name, meter in self.meters.items():
-            fmat = ".4f"
-            if meter.val < 0.01:
-                fmat = ".2E"
-            string += "{} {:{format}} \t".format(name, meter.val, format=fmat)
-        return string
+        parts = ["{} {:{format}} ".format(name, self._val[i],
+                                          format=".2E" if self._val[i] < 0.01 else ".4f")
+                 for name, i in self._idx.items()]
+        return "\t".join(parts) + "\t" if parts else ""
 
 
 class AverageMeter:
@@ -379,20 +452,49 @@ class AverageMeter:
         return "{self.avg:{format}}".format(self=self, format=format)
 
 
+def _iter_wavs(root):
+    """ Iterate over the wav files under a directory (recursively) using os.scandir,
+    which exposes the entry type without an extra stat call per file
+    Args:
+        root: str, path of the directory to explore
+    Yields:
+        str, path of each wav file found
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".wav"):
+                    yield entry.path
+
+
 def generate_tsv_wav_durations(audio_dir, out_tsv):
     """ Generate a dataframe with filename and duration of the file
     Args:
-        audio_dir: str, the path of the folder where audio files are (used by glob.glob)
+        audio_dir: str, the path of the folder where audio files are
         out_tsv: str, the path of the output tsv file
 
     Returns:
         pd.DataFrame, the dataframe containing filenames and durations
+    Note:
+        If out_tsv already exists it is used as a cache, only files not listed in it get their
+        header parsed again.
     """
-    meta_list = []
-    for file in glob.glob(os.path.join(audio_dir, "*.wav")):
-        d = soundfile.info(file).duration
-        meta_list.append([os.path.basename(file), d])
-    meta_df = pd.DataFrame(meta_list, columns=["filename", "duration"])
+    files = list(_iter_wavs(audio_dir))
+    durations = {}
+    if out_tsv is not None and os.path.exists(out_tsv):
+        cached_df = pd.read_csv(out_tsv, sep="\t")
+        durations = dict(zip(cached_df["filename"], cached_df["duration"]))
+    new_files = [f for f in files if os.path.basename(f) not in durations]
+    # Header reads are I/O bound and libsndfile releases the GIL, so probe them concurrently
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+        new_durations = list(pool.map(lambda f: soundfile.info(f).duration, new_files))
+    durations.update(zip((os.path.basename(f) for f in new_files), new_durations))
+    basenames = [os.path.basename(f) for f in files]
+    meta_df = pd.DataFrame({"filename": basenames,
+                            "duration": [durations[name] for name in basenames]})
     if out_tsv is not None:
         meta_df.to_csv(out_tsv, sep="\t", index=False, float_format="%.1f")
     return meta_df
@@ -410,25 +512,25 @@ def generate_tsv_from_isolated_events(wav_folder, out_tsv=None):
     if out_tsv is not None and os.path.exists(out_tsv):
         source_sep_df = pd.read_csv(out_tsv, sep="\t")
     else:
-        source_sep_df = pd.DataFrame()
+        frames = []
         list_dirs = [d for d in os.listdir(wav_folder) if osp.isdir(osp.join(wav_folder, d))]
         for dirname in list_dirs:
             list_isolated_files = []
-            for directory, subdir, fnames in os.walk(osp.join(wav_folder, dirname)):
-                for fname in fnames:
-                    if osp.splitext(fname)[1] in [".wav"]:
-                        # Get the level folders and keep it in the tsv
-                        subfolder = directory.split(dirname + os.sep)[1:]
-                        if len(subfolder) > 0:
-                            subdirs = osp.join(*subfolder)
+            stack = [osp.join(wav_folder, dirname)]
+            while stack:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.endswith(".wav"):
+                            # Keep the path relative to wav_folder (subfolders included) in the tsv
+                            list_isolated_files.append(osp.relpath(entry.path, wav_folder))
                         else:
-                            subdirs = ""
-                        # Append the subfolders and name in the list of files
-                        list_isolated_files.append(osp.join(dirname, subdirs, fname))
-                    else:
-                        warnings.warn(f"Not only wav audio files in the separated source folder,"
-                                      f"{fname} not added to the .tsv file")
-            source_sep_df = source_sep_df.append(pd.DataFrame(list_isolated_files, columns=["filename"]))
+                            warnings.warn(f"Not only wav audio files in the separated source folder,"
+                                          f"{entry.name} not added to the .tsv file")
+            frames.append(pd.DataFrame(list_isolated_files, columns=["filename"]))
+        # Concatenate once instead of appending (and copying) the frame per directory
+        source_sep_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["filename"])
         if out_tsv is not None:
             create_folder(os.path.dirname(out_tsv))
             source_sep_df.to_csv(out_tsv, sep="\t", index=False, float_format="%.3f")
@@ -448,8 +550,11 @@ def get_durations_df(gtruth_path, audio_dir=None):
         audio_dir = meta_path_to_audio_dir(cfg.synthetic)
     path, ext = os.path.splitext(gtruth_path)
     path_durations_synth = path + "_durations" + ext
-    if not os.path.exists(path_durations_synth):
-        durations_df = generate_tsv_wav_durations(audio_dir, path_durations_synth)
-    else:
+    if not os.path.isdir(audio_dir) and os.path.exists(path_durations_synth):
+        # Audio removed or unmounted (e.g. training from precomputed features), use the tsv as is
         durations_df = pd.read_csv(path_durations_synth, sep="\t")
+    else:
+        # generate_tsv_wav_durations reuses the existing tsv as a cache, so warm reruns
+        # only parse the headers of files added since the last call
+        durations_df = generate_tsv_wav_durations(audio_dir, path_durations_synth)
     return durations_df
\ No newline at end of file